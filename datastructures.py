@@ -1,157 +1,275 @@
+import heapq
 import logging
-from collections import namedtuple
+import sys
+from operator import itemgetter
 
+import numpy as np
 
-QueryData = namedtuple("QueryData", ["query_text", "prefix_count"])
-TopQuery = namedtuple("TopQuery", ["id", "count"])
+try:
+    import numba
+except ImportError:
+    # numba is optional: without it bulk ingest falls back to the per-row walk
+    numba = None
+
+
+# Maximum size accepted for a top queries request
 TOP_QUERIES_SIZE_K = 50
+# Timestamps always have 14 digits so the Trie depth is fixed
+TRIE_DEPTH = 14
+# Strips the separators of a (possibly truncated) timestamp, e.g. "2016-02-10 11"
+PREFIX_SEPARATORS = str.maketrans("", "", "-: ")
+# Maximum number of cached prefix -> node resolutions
+PREFIX_CACHE_MAX_SIZE = 4096
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _bulk_walk(codes, query_ids, children, distinct, num_nodes, seen_counts):
+        """Compiled trie walk over a batch of rows
+        codes is an int64[n, TRIE_DEPTH] matrix of digits, children/distinct are the
+        per-depth node arrays (grown in place by doubling, like Trie._new_node), and
+        seen_counts maps a packed (depth, node_id, query_id) key to the number of
+        times that query reached that node: it drives the distinct counters here
+        and is scattered into the per-node query counts by Trie.finalize().
+        """
+        n = codes.shape[0]
+        for i in range(n):
+            node_id = 0
+            query_id = query_ids[i]
+            for depth in range(TRIE_DEPTH):
+                digit = codes[i, depth]
+
+                # Search for the digit in the children of the current node
+                child_id = children[depth][node_id, digit]
+                if child_id < 0:
+                    # No child yet for this prefix, create one
+                    child_id = num_nodes[depth + 1]
+                    num_nodes[depth + 1] = child_id + 1
+                    if depth + 1 < TRIE_DEPTH and child_id >= children[depth + 1].shape[0]:
+                        grown = np.full((child_id * 2, 10), -1, dtype=np.int32)
+                        grown[:child_id] = children[depth + 1]
+                        children[depth + 1] = grown
+                    if child_id >= distinct[depth + 1].shape[0]:
+                        grown_distinct = np.zeros(child_id * 2, dtype=np.int64)
+                        grown_distinct[:child_id] = distinct[depth + 1]
+                        distinct[depth + 1] = grown_distinct
+                    children[depth][node_id, digit] = child_id
+                node_id = child_id
+
+                # Packed key: 4 bits of depth, 27 bits of node_id, 32 bits of query_id
+                key = ((np.int64(depth + 1) << 27 | node_id) << 32) | query_id
+                if key in seen_counts:
+                    count = seen_counts[key] + 1
+                else:
+                    # First time we get this query at this node
+                    count = 1
+                    distinct[depth + 1][node_id] += 1
+                seen_counts[key] = count
 
 
 class QueryStore(object):
-    """Store information about queries in a list.
+    """Store the distinct query texts in a list.
     The query id is the index of the query in this list
-    The stored data for each query is the tuple (query_text, prefix_count)
-    The prefix_count is dictionary containing the number of times the query appears at
-    each prefix. It is used when processing the logs but can be discarded after.
+    The text_index dictionary maps a query text back to its id for deduplication.
+    It is used when processing the logs but can be discarded after.
     """
+    __slots__ = ("query_texts", "text_index", "finalized")
+
     def __init__(self):
-        self.queries_data = []
+        self.query_texts = []
         self.text_index = {}
         self.finalized = False
 
     def add(self, query_text):
         if self.finalized:
             raise RuntimeError("Cannot add query info to the QueryStore because it is finalized")
+        # Interning lets duplicated texts share one string object and makes the
+        # dedup lookup below an identity check in the common case
+        query_text = sys.intern(query_text)
         if query_text in self.text_index:
             return self.text_index[query_text]
-        query_id = len(self.queries_data)
-        self.queries_data.append(QueryData(query_text, {}))
+        query_id = len(self.query_texts)
+        self.query_texts.append(query_text)
         self.text_index[query_text] = query_id
         return query_id
 
-    def get(self, query_id):
-        return self.queries_data[query_id]
+    def get_text(self, query_id):
+        return self.query_texts[query_id]
 
     def finalize(self):
         """Free up memory once aggregations are done"""
         self.text_index.clear()
-        for qd in self.queries_data:
-            qd.prefix_count.clear()
         self.finalized = True
 
 
-class TopQueriesCache(object):
-    """Cache the top k most popular queries in a list of (query_id, query_count) tuples
-    ordered by query_count"""
-    def __init__(self):
-        self.top_queries = []
-
-    def find_query(self, query_id):
-        """This is O(k) but could be optimized by using the query count to find
-        the entry faster in the sorted array"""
-        for idx, tq in enumerate(self.top_queries):
-            if tq.id == query_id:
-                return idx
-        return None
-
-    def update(self, query_id, query_count):
-        """Update the top_queries given the current query info
-        This is O(k log k) in the worst case, O(k) on average, could be improved(find_query)
-        """
-        # If the query is already in our cache, update the count and sort
-        idx = self.find_query(query_id)
-        if idx is not None:
-            assert self.top_queries[idx].id == query_id
-            assert self.top_queries[idx].count == query_count - 1
-            self.top_queries[idx] = TopQuery(query_id, query_count)
-            self.top_queries.sort(key=lambda tq: -tq.count)
-            return
-
-        # The query is not yet in our cache
-        # If the cache is not full, just append the data
-        if len(self.top_queries) < TOP_QUERIES_SIZE_K:
-            self.top_queries.append(TopQuery(query_id, query_count))
-            self.top_queries.sort(key=lambda tq: -tq.count)
-            return
-
-        # We only need to add the query if the count is better than last_top_query
-        last_top_query = self.top_queries[-1]
-        if query_count > last_top_query.count:
-            self.top_queries[-1] = TopQuery(query_id, query_count)
-            self.top_queries.sort(key=lambda tq: -tq.count)
-
-    def get(self, limit):
-        return self.top_queries[:limit]
-
-
-class TrieNode(object):
-    def __init__(self):
-        # There are 10 children, one for each digit
-        self.children = [None] * 10
-        # Cache the number of distinct queries for this prefix
-        self.distinct = 0
-        # Cache the top queries for this prefix
-        self.top_queries_cache = TopQueriesCache()
-
-
 class Trie(object):
     """Trie of timestamps
     Insertion and query of timestamp prefix is very fast but there is a large space
     complexity: years * 12 * 31 * 24 * 60 * 60 potential leaves(a bit more nodes),
-    and at each node we store pointers for the top k queries"""
+    and at each node we store pointers for the top k queries
+
+    The depth is fixed at TRIE_DEPTH and the alphabet is the 10 digits, so instead
+    of allocating one Python object per node we store all nodes of a given depth in
+    contiguous per-depth arrays and identify a node by (depth, node_id):
+    - children[depth][node_id, digit] is the node_id of the child at depth+1, or -1
+    - distinct[depth][node_id] caches the number of distinct queries for the prefix
+    - query_counts[depth][node_id] maps query_id -> count for the prefix
+      (populated by finalize(), see _seen_counts)
+    This cuts a node from hundreds of bytes of pointered Python objects to a few
+    dozen bytes of contiguous integer data, which matters with millions of nodes.
+    The root is node 0 at depth 0."""
+    __slots__ = ("query_store", "children", "distinct", "query_counts", "num_nodes",
+                 "_seen_counts", "_prefix_cache")
+
     def __init__(self):
-        self.root = TrieNode()
         self.query_store = QueryStore()
+        self.children = [np.full((1, 10), -1, dtype=np.int32) for _ in range(TRIE_DEPTH)]
+        self.distinct = [np.zeros(1, dtype=np.int64) for _ in range(TRIE_DEPTH + 1)]
+        self.query_counts = [[{}] for _ in range(TRIE_DEPTH + 1)]
+        # Number of nodes in use at each depth(the arrays above grow by doubling)
+        self.num_nodes = [1] + [0] * TRIE_DEPTH
+        # packed (depth, node_id, query_id) -> count, accumulated during ingest
+        # One big table is more memory-efficient than per-node dicts; finalize()
+        # scatters it into query_counts for querying
+        self._seen_counts = None
+        # Cache prefix -> node resolutions: serving traffic repeats a small set of
+        # prefixes, and the grammar only allows a few thousand distinct ones anyway
+        self._prefix_cache = {}
+
+    def _new_node(self, depth):
+        """Allocate a node at the given depth and return its node_id"""
+        node_id = self.num_nodes[depth]
+        if depth < TRIE_DEPTH and node_id >= self.children[depth].shape[0]:
+            grown = np.full((node_id * 2, 10), -1, dtype=np.int32)
+            grown[:node_id] = self.children[depth]
+            self.children[depth] = grown
+        if node_id >= self.distinct[depth].shape[0]:
+            grown = np.zeros(node_id * 2, dtype=np.int64)
+            grown[:node_id] = self.distinct[depth]
+            self.distinct[depth] = grown
+        if node_id >= len(self.query_counts[depth]):
+            self.query_counts[depth].append({})
+        self.num_nodes[depth] = node_id + 1
+        return node_id
+
+    def add(self, time_digits, query_text):
+        """Record a query in our Trie structure
+        time_digits is the 14-digit string of an already validated timestamp,
+        e.g. "20160210110350" for 2016-02-10 11:03:50
+        """
+        self._add_row(time_digits, self.query_store.add(query_text))
+
+    def _ensure_seen_counts(self):
+        """Create the ingest count table on first use
+        It is a numba typed dict when the compiled walk is available, and a plain
+        dict otherwise - the Python walk handles both"""
+        if self._seen_counts is None:
+            if numba is None:
+                self._seen_counts = {}
+            else:
+                self._seen_counts = numba.typed.Dict.empty(numba.types.int64, numba.types.int64)
+        return self._seen_counts
+
+    def bulk_add(self, all_time_digits, query_ids):
+        """Record a batch of queries, given per-row digit strings and QueryStore ids
+        This is the ingest entry point for the vectorized parsing path, where
+        query texts have already been deduplicated and registered in the store
+        With numba installed the trie walk runs compiled"""
+        if numba is None:
+            add_row = self._add_row
+            for time_digits, query_id in zip(all_time_digits, query_ids):
+                if isinstance(time_digits, bytes):
+                    time_digits = time_digits.decode()
+                add_row(time_digits, query_id)
+            return
 
-    def add(self, timestamp, query_text):
-        """Record a query in our Trie structure"""
-        time_digits = [int(c) for c in timestamp if c.isdigit()]
-        assert len(time_digits) == 14
-
-        query_id = self.query_store.add(query_text)
-        prefix_count = self.query_store.get(query_id).prefix_count
+        seen_counts = self._ensure_seen_counts()
+        codes = (np.asarray(all_time_digits, dtype=f"S{TRIE_DEPTH}")
+                 .view(np.uint8).reshape(-1, TRIE_DEPTH).astype(np.int64) - ord("0"))
+        query_ids = np.asarray(query_ids, dtype=np.int64)
+        children = numba.typed.List(self.children)
+        distinct = numba.typed.List(self.distinct)
+        num_nodes = np.asarray(self.num_nodes, dtype=np.int64)
+        _bulk_walk(codes, query_ids, children, distinct, num_nodes, seen_counts)
+        # The walk may have replaced grown arrays inside the typed lists
+        self.children = list(children)
+        self.distinct = list(distinct)
+        self.num_nodes = [int(n) for n in num_nodes]
+        for depth, counts in enumerate(self.query_counts):
+            while len(counts) < self.num_nodes[depth]:
+                counts.append({})
+
+    def _add_row(self, time_digits, query_id):
+        assert len(time_digits) == TRIE_DEPTH
+        seen_counts = self._ensure_seen_counts()
 
         # Do a Trie traversal and update each node with the query info
-        node = self.root
-        prefix = ""
-        for digit in time_digits:
-            prefix += str(digit)
+        node_id = 0
+        for depth, digit_char in enumerate(time_digits):
+            digit = int(digit_char)
 
             # Search for the digit in the children of the current node
-            if node.children[digit] is None:
+            child_id = int(self.children[depth][node_id, digit])
+            if child_id < 0:
                 # No child yet for this prefix, create one
-                new_node = TrieNode()
-                node.children[digit] = new_node
-            node = node.children[digit]
-
-            # If this is the first time we get this query at this node, increment the distinct queries counter
-            if prefix not in prefix_count:
-                prefix_count[prefix] = 1
-                node.distinct += 1
+                child_id = self._new_node(depth + 1)
+                self.children[depth][node_id, digit] = child_id
+            node_id = child_id
+
+            # Count the query at this node, using the same packed key as the
+            # compiled walk: one big table is much more compact than a small dict
+            # at each of millions of nodes
+            # If this is the first time we get this query here, it is a new distinct query
+            key = ((depth + 1) << 27 | node_id) << 32 | query_id
+            if key in seen_counts:
+                seen_counts[key] += 1
             else:
-                prefix_count[prefix] += 1
-
-            # Update the node top queries
-            node.top_queries_cache.update(query_id, prefix_count[prefix])
+                seen_counts[key] = 1
+                self.distinct[depth + 1][node_id] += 1
 
     def get_node_at_prefix(self, prefix):
-        """Return the node in our Trie corresponding to the given prefix, or None if missing.
+        """Return the (depth, node_id) in our Trie corresponding to the given prefix,
+        or None if missing.
         prefix is assumed to be a timestamp like 2016-02-10 11:03:50 truncated
         at any point, e.g. 2016, 2016-02, ...
         """
-        node = self.root
-        prefix_digits = [int(c) for c in prefix if c.isdigit()]
-        if not prefix_digits:
+        try:
+            return self._prefix_cache[prefix]
+        except KeyError:
+            pass
+
+        # One C call to drop the separators instead of a per-character loop
+        digits = prefix.translate(PREFIX_SEPARATORS)
+        if not digits or not (digits.isascii() and digits.isdigit()):
             raise InvalidDatePrefix(f"The date prefix '{prefix}' is invalid")
 
-        for digit in prefix_digits:
-            node = node.children[digit]
-            if node is None:
-                return None
+        node = None
+        if len(digits) <= TRIE_DEPTH:
+            node_id = 0
+            for depth, digit in enumerate(digits.encode("ascii")):
+                node_id = int(self.children[depth][node_id, digit - 48])  # ord("0") == 48
+                if node_id < 0:
+                    break
+            else:
+                node = len(digits), node_id
+
+        if len(self._prefix_cache) >= PREFIX_CACHE_MAX_SIZE:
+            self._prefix_cache.clear()
+        self._prefix_cache[prefix] = node
         return node
 
     def finalize(self):
-        """Free up memory once aggregations are done"""
+        """Scatter the counts accumulated during ingest into the per-node query
+        counts, and free up memory once aggregations are done
+        Must be called before top_queries_by_prefix"""
+        if self._seen_counts is not None:
+            node_id_mask = (1 << 27) - 1
+            query_id_mask = (1 << 32) - 1
+            for key, count in self._seen_counts.items():
+                query_id = key & query_id_mask
+                depth_node = key >> 32
+                self.query_counts[depth_node >> 27][depth_node & node_id_mask][query_id] = count
+            self._seen_counts = None
         self.query_store.finalize()
 
     def top_queries_by_prefix(self, prefix, size):
@@ -159,18 +277,25 @@ class Trie(object):
         if size > TOP_QUERIES_SIZE_K:
             raise InvalidQuerySize(f"The maximum size supported for this query is {TOP_QUERIES_SIZE_K}")
         node = self.get_node_at_prefix(prefix)
-        if not node:
+        if node is None:
             return []
-        top_queries = node.top_queries_cache.get(size)
+        depth, node_id = node
+        # The top queries are computed on demand: most nodes are never queried, so
+        # a lazy heapq.nlargest here beats maintaining a top-k cache at every node
+        # on every ingested row(and the result is memoized upstream anyway)
+        top_queries = heapq.nlargest(size, self.query_counts[depth][node_id].items(),
+                                     key=itemgetter(1))
         # Replace the query_ids with the query_text before returning
-        return [(self.query_store.get(tq.id).query_text, tq.count) for tq in top_queries]
+        return [(self.query_store.get_text(query_id), count)
+                for query_id, count in top_queries]
 
     def distinct_queries_by_prefix(self, prefix):
         logging.info(f"Get the number of distinct queries that have been done with date prefix {prefix}.")
         node = self.get_node_at_prefix(prefix)
-        if not node:
+        if node is None:
             return 0
-        return node.distinct
+        depth, node_id = node
+        return int(self.distinct[depth][node_id])
 
 
 class InvalidQuerySize(Exception):
@@ -184,10 +309,11 @@ class InvalidDatePrefix(Exception):
 if __name__ == "__main__":
     # Run some tests
     trie = Trie()
-    trie.add("2014-08-01 00:03:49", "vungle")
-    trie.add("2015-09-01 00:03:49", "vungle")
-    trie.add("2015-08-01 00:03:49", "test")
-    trie.add("2015-11-01 00:03:49", "test")
+    trie.add("20140801000349", "vungle")
+    trie.add("20150901000349", "vungle")
+    trie.add("20150801000349", "test")
+    trie.add("20151101000349", "test")
+    trie.finalize()
 
     assert trie.distinct_queries_by_prefix('2015') == 2
     assert trie.distinct_queries_by_prefix('2015-08') == 1
@@ -1,8 +1,14 @@
 import logging
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, unquote
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional: without it responses are serialized with the stdlib json
+    orjson = None
+
 from analyser import LogAnalyser
 from datastructures import InvalidQuerySize, InvalidDatePrefix
 
@@ -10,11 +16,25 @@ HN_LOGS_FILE = "hn_logs.tsv"
 COUNT_QUERY_PATH = "/1/queries/count/"
 TOP_QUERY_PATH = "/1/queries/popular/"
 TOP_QUERY_SIZE_PARAM = "size"
+# Maximum number of cached serialized responses
+RESPONSE_CACHE_MAX_SIZE = 65536
+
+
+def serialize_json(data):
+    """Serialize a response to JSON bytes, in native code when orjson is available"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
 
 
 def make_handler(log_analyser):
     """A small web server for our log analyser demo
     """
+    # The analyser is read-only, so a given request path always produces the same
+    # response: cache the serialized bytes and skip the trie and JSON encoding
+    # entirely on repeated requests
+    response_cache = {}
+
     class LogAnalyserHandler(BaseHTTPRequestHandler):
         def __init__(self, *args, **kwargs):
             self.log_analyser = log_analyser
@@ -28,6 +48,10 @@ def make_handler(log_analyser):
             return parts[0], parse_qs(parts[1])
 
         def do_GET(self):
+            cached = response_cache.get(self.path)
+            if cached is not None:
+                self.send_json_bytes(cached)
+                return
             try:
                 if self.path.startswith(COUNT_QUERY_PATH):
                     self.get_distinct_queries()
@@ -57,11 +81,18 @@ def make_handler(log_analyser):
             self.send_in_json(data)
 
         def send_in_json(self, data):
-            """Send data encoded as JSON"""
+            """Send data encoded as JSON and cache the response for this path"""
+            body = serialize_json(data)
+            if len(response_cache) < RESPONSE_CACHE_MAX_SIZE:
+                response_cache[self.path] = body
+            self.send_json_bytes(body)
+
+        def send_json_bytes(self, body):
+            """Send an already serialized JSON response"""
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
-            self.wfile.write(json.dumps(data).encode("utf-8"))
+            self.wfile.write(body)
 
     return LogAnalyserHandler
 
@@ -75,7 +106,9 @@ def run(port=8080):
 
     handler_class = make_handler(log_analyser)
     server_address = ("", port)
-    httpd = HTTPServer(server_address, handler_class)
+    # Threaded server: the analyser is read-only once the logs are processed, so
+    # requests can safely be served concurrently instead of one at a time
+    httpd = ThreadingHTTPServer(server_address, handler_class)
     logging.info("Starting httpd...\n")
     try:
         httpd.serve_forever()